@@ -2,10 +2,211 @@
 # .github/scripts/code_review.py
 
 import os
+import re
 import sys
 import json
-import requests
+import hashlib
+import time
+import random
+import tempfile
+import functools
+from collections import deque
 from datetime import datetime
+from pathlib import Path
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# requests, base64, gzip and email.utils are imported where they are used, so
+# runs with nothing to report never pay for loading the HTTP stack.
+
+GEMINI_API_BASE = "https://generativelanguage.googleapis.com/v1beta"
+GEMINI_MODEL = "gemini-2.0-flash"
+
+# Directory for exact-match Gemini response cache (SHA-256 of prompt -> text);
+# the workflow restores and saves it with actions/cache between runs
+GEMINI_CACHE_DIR = os.getenv('GEMINI_CACHE_DIR', '/tmp/gemini_cache')
+
+# Environment variables the bot cannot run without
+REQUIRED_ENV_VARS = ('GITHUB_TOKEN', 'GITHUB_REPOSITORY', 'GITHUB_SHA')
+
+# GitHub retry policy for rate limits and transient server errors. Server
+# errors are only retried for idempotent methods: GitHub often returns them
+# after a POST has been applied, and replaying it would duplicate the write.
+GITHUB_MAX_RETRIES = 4
+GITHUB_TRANSIENT_STATUSES = (502, 503, 504)
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+GITHUB_MAX_RETRY_DELAY = 300
+
+# Input files larger than this keep only their head and tail
+READ_MAX_BYTES = 64 * 1024
+READ_HEAD_BYTES = 16 * 1024
+
+# GitHub rejects issue bodies longer than this; test logs that do not fit are
+# linked, compressed or cut down to their tail instead of embedded whole
+ISSUE_BODY_LIMIT = 65536
+ISSUE_BODY_MARGIN = 1024
+GIST_MAX_BYTES = 1024 * 1024
+
+# Lines of context kept around each failure marker in test output
+FAILURE_CONTEXT_LINES = 20
+FAILURE_MARKERS = ('FAIL', 'PANIC', 'panic:')
+
+# Static prompt preamble, sent as the system instruction ahead of the variable
+# report so Gemini's implicit prefix caching can apply to it
+ANALYSIS_INSTRUCTION = """You are an experienced Go developer and code reviewer. Please analyze the following code quality report and provide actionable recommendations.
+
+Project Context: This is a Go project called "catmit" (AI-powered commit message generator).
+
+The report consists of a "Test Results" section and a "Static Analysis Report" section.
+
+Please provide:
+1. **Priority Assessment**: Sort issues by urgency (Critical/High/Medium/Low)
+2. **Root Cause Analysis**: What could be causing these issues?
+3. **Specific Actions**: Concrete steps to fix each issue
+4. **Implementation Order**: Best sequence for solving improvements
+5. **Prevention Recommendations**: How to avoid these issues in the future
+
+Focus on practical, actionable advice suitable for Go projects. Be concise but comprehensive.
+Format your response using clear markdown headings and bullet points."""
+
+# Report used when there is nothing to analyze, so no Gemini call is made
+NO_INPUT_REPORT = """## 🤖 AI Code Review Summary
+
+No test output or static analysis report was available to analyze."""
+
+# Repository node ID and label node IDs, needed by the GraphQL mutations below
+REPOSITORY_QUERY = """
+query($owner: String!, $name: String!) {
+  repository(owner: $owner, name: $name) {
+    id
+    labels(first: 50) { nodes { id name } }
+  }
+}"""
+
+# Mutations run in order, so the PR is opened after the analysis commit lands
+COMMIT_AND_PULL_REQUEST_MUTATION = """
+mutation($commit: CreateCommitOnBranchInput!, $pullRequest: CreatePullRequestInput!) {
+  createCommitOnBranch(input: $commit) {
+    commit { oid }
+  }
+  createPullRequest(input: $pullRequest) {
+    pullRequest { id number url }
+  }
+}"""
+
+# Labels and comment both hang off the new PR's node ID, so they share one request
+LABEL_AND_COMMENT_MUTATION = """
+mutation($prId: ID!, $labelIds: [ID!]!, $body: String!) {
+  labels: addLabelsToLabelable(input: {labelableId: $prId, labelIds: $labelIds}) {
+    clientMutationId
+  }
+  comment: addComment(input: {subjectId: $prId, body: $body}) {
+    clientMutationId
+  }
+}"""
+
+# Used when none of the labels exist yet, since addLabelsToLabelable rejects an empty list
+COMMENT_MUTATION = """
+mutation($prId: ID!, $body: String!) {
+  comment: addComment(input: {subjectId: $prId, body: $body}) {
+    clientMutationId
+  }
+}"""
+
+def json_loads(content):
+    """Decode a JSON response body, using orjson when it is installed"""
+    return orjson.loads(content) if orjson else json.loads(content)
+
+def json_dumps(obj):
+    """Encode a JSON request body to bytes, using orjson when it is installed"""
+    return orjson.dumps(obj) if orjson else json.dumps(obj).encode('utf-8')
+
+# Request headers for pre-serialized JSON bodies
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+def env_flag(env, name):
+    """Parse a boolean environment flag, accepting common truthy spellings"""
+    return env.get(name, '').strip().lower() in ('1', 'true', 'yes', 'on')
+
+def write_file_atomic(path, text):
+    """Write text to path via a temp file so readers never see partial content"""
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+    except OSError:
+        os.unlink(tmp_path)
+        raise
+
+def create_session(headers=None):
+    """Create a pooled keep-alive session that retries connection failures"""
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+    
+    session = requests.Session()
+    if headers:
+        session.headers.update(headers)
+    # Status-based retries are left to GitHubAPI._send, which knows which
+    # requests are safe to replay and caps how long it waits. urllib3 would
+    # otherwise retry 413/429/503 responses carrying Retry-After on its own.
+    retry = Retry(total=3, backoff_factor=0.5, respect_retry_after_header=False, raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry)
+    session.mount("https://", adapter)
+    return session
+
+def parse_retry_after(value):
+    """Return the seconds a Retry-After header asks for, or None if unparseable"""
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    
+    # RFC 9110 also allows an HTTP date
+    from email.utils import parsedate_to_datetime
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at is None:
+        return None
+    return retry_at.timestamp() - time.time()
+
+def github_retry_delay(response, attempt, method='GET'):
+    """Return seconds to wait before retrying a GitHub response, or None to give up"""
+    status = response.status_code
+    headers = response.headers
+    retry_after = headers.get('Retry-After')
+    exhausted = headers.get('X-RateLimit-Remaining') == '0' and headers.get('X-RateLimit-Reset')
+    
+    # Plain 403s are permission errors, not worth retrying
+    rate_limited = status == 429 or (status == 403 and (
+        exhausted or retry_after or 'rate limit' in response.text.lower()))
+    if not rate_limited and (status not in GITHUB_TRANSIENT_STATUSES or
+                             method.upper() not in IDEMPOTENT_METHODS):
+        return None
+    
+    delay = None
+    if exhausted:
+        try:
+            delay = float(headers['X-RateLimit-Reset']) - time.time()
+        except ValueError:
+            pass
+    elif retry_after:
+        delay = parse_retry_after(retry_after)
+    if delay is None:
+        delay = min(60, 2 ** attempt) * random.uniform(0.5, 1.5)
+    
+    if delay > GITHUB_MAX_RETRY_DELAY:
+        print(f"GitHub rate limit resets in {delay:.0f}s, not waiting")
+        return None
+    return max(0, delay)
 
 class GitHubAPI:
     def __init__(self, token, repo):
@@ -14,172 +215,461 @@ class GitHubAPI:
         self.base_url = "https://api.github.com"
         self.headers = {
             "Authorization": f"Bearer {token}",
-            "Accept": "application/vnd.github.v3+json",
-            "Content-Type": "application/json"
+            "Accept": "application/vnd.github.v3+json"
         }
+        self._session = None
+    
+    @property
+    def session(self):
+        if self._session is None:
+            self._session = create_session(self.headers)
+        return self._session
+    
+    def _send(self, method, url, data=None):
+        body = json_dumps(data) if data is not None else None
+        for attempt in range(GITHUB_MAX_RETRIES):
+            response = self.session.request(method, url, data=body, headers=JSON_HEADERS if body else None)
+            delay = github_retry_delay(response, attempt, method)
+            if delay is None or attempt == GITHUB_MAX_RETRIES - 1:
+                return response
+            print(f"GitHub API {response.status_code}, retrying in {delay:.1f}s")
+            time.sleep(delay)
     
     def request(self, method, endpoint, data=None):
         url = f"{self.base_url}/repos/{self.repo}{endpoint}"
-        response = requests.request(method, url, headers=self.headers, json=data)
+        response = self._send(method, url, data)
+        
+        if not response.ok:
+            print(f"GitHub API error: {response.status_code} {response.text}")
+            return None
+        
+        # DELETE and some other endpoints answer 204 with no body
+        return json_loads(response.content) if response.content else {}
+    
+    def create_gist(self, description, filename, content):
+        """Create a secret gist and return its URL"""
+        gist_data = {
+            "description": description,
+            "public": False,
+            "files": {filename: {"content": content}}
+        }
+        response = self._send('POST', f"{self.base_url}/gists", gist_data)
         
         if not response.ok:
             print(f"GitHub API error: {response.status_code} {response.text}")
             return None
         
-        return response.json()
+        return json_loads(response.content).get('html_url')
+    
+    def graphql(self, query, variables=None):
+        response = self._send('POST', f"{self.base_url}/graphql", {"query": query, "variables": variables or {}})
+        
+        if not response.ok:
+            print(f"GitHub GraphQL error: {response.status_code} {response.text}")
+            return None
+        
+        result = json_loads(response.content)
+        if result.get('errors'):
+            print(f"GitHub GraphQL error: {result['errors']}")
+        return result.get('data')
+    
+    def get_repository_ids(self):
+        """Return the repository node ID and a lowercased label name -> node ID map"""
+        owner, name = self.repo.split('/', 1)
+        data = self.graphql(REPOSITORY_QUERY, {"owner": owner, "name": name})
+        if not data or not data.get('repository'):
+            return None, {}
+        
+        repository = data['repository']
+        # GitHub label names are case-insensitive
+        labels = {label['name'].lower(): label['id'] for label in repository['labels']['nodes']}
+        return repository['id'], labels
 
 class CodeReviewBot:
+    # Static body templates; only the str.format fields vary per run
+    _ISSUE_BODY_TEMPLATE = """## Test Failure Detected
+
+Commit: {sha}
+
+{ai_report}
+
+### Test Results:
+{test_output}
+
+---
+*This issue was automatically created by AI-powered code analysis.*"""
+    
+    _INLINE_TEST_OUTPUT_TEMPLATE = """<details>
+<summary>Click to view detailed test output</summary>
+
+```
+{test_results}
+```
+</details>"""
+    
+    _GIST_TEST_OUTPUT_TEMPLATE = "Test output is too large to embed, see the [full test log]({url})."
+    
+    _COMPRESSED_TEST_OUTPUT_TEMPLATE = """<details>
+<summary>Test output is too large to embed ({size} characters); decode with <code>base64 -d | gunzip</code></summary>
+
+```
+{data}
+```
+</details>"""
+    
+    _TRUNCATED_TEST_OUTPUT_TEMPLATE = """<details>
+<summary>Test output is too large to embed ({size} characters); showing the end of the log</summary>
+
+```
+{test_results}
+```
+</details>"""
+    
+    _OMITTED_TEST_OUTPUT_TEMPLATE = "Test output omitted ({size} characters), see the workflow run log."
+    
+    _ANALYSIS_FILE_TEMPLATE = """# Code Quality Analysis Report
+
+Generated: {generated}
+Commit: {sha}
+
+{analysis_report}
+
+## AI Analysis:
+{ai_report}
+
+## Recommended Actions:
+1. **Reduce Complexity**: Break down complex functions into smaller ones
+2. **Extract Constants**: Define constants for repeated literal values
+3. **Split Large Files**: Consider splitting large files into smaller modules
+4. **Fix Static Issues**: Address issues found by staticcheck
+
+## Next Steps:
+- Review the above findings
+- Apply suggested refactoring
+- Ensure all tests still pass
+- Update this file when complete
+"""
+    
+    _PR_BODY_TEMPLATE = """## Automated Code Quality Review
+
+This PR was automatically created after detecting code quality issues in commit {sha}.
+
+{ai_report}
+
+### Detailed Analysis:
+<details>
+<summary>Click to view technical details</summary>
+
+{analysis_report}
+</details>
+
+### This PR contains:
+- Added `CODE_QUALITY_ANALYSIS.md` with detailed findings
+- AI-generated recommendations and action plan
+
+### Required Actions:
+- [ ] Review the AI analysis above
+- [ ] Follow the recommended implementation order
+- [ ] Apply suggested refactoring
+- [ ] Run tests to ensure changes don't break functionality
+- [ ] Update or remove analysis file after addressing issues
+
+**Note**: This is an automated PR with AI-assisted analysis. Please review carefully before merging."""
+    
+    _PR_COMMENT = """## 🤖 Code Quality Analysis
+
+I've analyzed the code and found some areas for improvement. Please review the `CODE_QUALITY_ANALYSIS.md` file added in this PR for detailed findings.
+
+If you have any questions about the recommendations, feel free to ask! You can also push new commits to this branch to run additional analysis."""
+    
+    # Fallback insights as (flag, priority, message), in display order
+    _FALLBACK_MSGS = (
+        ('fail', 'critical', '🚨 **Critical**: Test failures detected - fix immediately'),
+        ('has_complexity', 'high', '🔄 **High**: Complex functions found - consider refactoring'),
+        ('has_const_issues', 'medium', '📋 **Medium**: Duplicate constants - extract as named constants'),
+        ('has_large_files', 'medium', '📁 **Medium**: Large files detected - consider splitting'),
+        ('has_static_issues', 'high', '🔍 **High**: Static analysis issues - check staticcheck warnings')
+    )
+    _PRIORITY_ORDER = ('critical', 'high', 'medium')
+    
+    _FALLBACK_REPORT_TEMPLATE = """## 🤖 AI Code Review Summary (Fallback Analysis)
+
+**Priority**: {priority}
+
+### Identified Issues:
+{insights}
+
+### Recommended Actions:
+1. Fix test failures first (highest priority)
+2. Address staticcheck warnings
+3. Refactor complex functions
+4. Extract duplicate constants
+5. Split large files
+
+*Configure GEMINI_API_KEY for detailed AI insights.*"""
+    
     def __init__(self):
         # Get configuration from environment variables
-        self.github_token = os.getenv('GITHUB_TOKEN')
-        self.gemini_api_key = os.getenv('GEMINI_API_KEY')
-        self.repo = os.getenv('GITHUB_REPOSITORY')
-        self.sha = os.getenv('GITHUB_SHA')
-        self.test_exit_code = os.getenv('TEST_EXIT_CODE')
+        env = os.environ
+        missing = [name for name in REQUIRED_ENV_VARS if not env.get(name, '').strip()]
+        if missing:
+            raise ValueError(f"Missing required environment variables: {', '.join(missing)}")
+        
+        self.github_token = env['GITHUB_TOKEN'].strip()
+        self.gemini_api_key = env.get('GEMINI_API_KEY')
+        self.repo = env['GITHUB_REPOSITORY'].strip()
+        self.sha = env['GITHUB_SHA'].strip()
+        
+        # Branch names and GraphQL lookups derive from these, so reject bad values
+        # before any API call is made
+        if not re.fullmatch(r'[0-9a-fA-F]{7,}', self.sha):
+            raise ValueError(f"GITHUB_SHA must be a commit SHA of at least 7 hex characters, got {self.sha!r}")
+        if not re.fullmatch(r'[^/\s]+/[^/\s]+', self.repo):
+            raise ValueError(f"GITHUB_REPOSITORY must be in owner/name form, got {self.repo!r}")
+        self.short_sha = self.sha[:7]
+        self.test_exit_code = env.get('TEST_EXIT_CODE')
+        
+        # Optional token with gist scope; the Actions GITHUB_TOKEN cannot create gists
+        self.gist_token = env.get('GIST_TOKEN', '').strip() or None
         
         # Issue flags
-        self.has_complexity = os.getenv('HAS_COMPLEXITY') == 'true'
-        self.has_const_issues = os.getenv('HAS_CONST_ISSUES') == 'true'
-        self.has_large_files = os.getenv('HAS_LARGE_FILES') == 'true'
-        self.has_static_issues = os.getenv('HAS_STATIC_ISSUES') == 'true'
+        self.has_complexity = env_flag(env, 'HAS_COMPLEXITY')
+        self.has_const_issues = env_flag(env, 'HAS_CONST_ISSUES')
+        self.has_large_files = env_flag(env, 'HAS_LARGE_FILES')
+        self.has_static_issues = env_flag(env, 'HAS_STATIC_ISSUES')
         
         # GitHub API client
         self.github = GitHubAPI(self.github_token, self.repo)
+        
+        # Reused across Gemini calls for connection keep-alive
+        self._gemini_session = None
+        
+        # Input file contents, keyed by (filename, max_bytes)
+        self._file_cache = {}
     
-    def read_file(self, filename):
-        """Read file contents"""
-        try:
-            with open(filename, 'r', encoding='utf-8') as f:
-                return f.read()
-        except FileNotFoundError:
+    @property
+    def gemini_session(self):
+        if self._gemini_session is None:
+            self._gemini_session = create_session()
+        return self._gemini_session
+    
+    def read_file(self, filename, max_bytes=READ_MAX_BYTES):
+        """Read file contents, once per run since the inputs do not change"""
+        key = (filename, max_bytes)
+        if key not in self._file_cache:
+            self._file_cache[key] = self._read_file(filename, max_bytes)
+        return self._file_cache[key]
+    
+    def _read_file(self, filename, max_bytes):
+        """Read file contents, keeping only the head and tail of large files"""
+        path = Path(filename)
+        if not path.is_file():
             print(f"File {filename} does not exist")
             return ""
-        except Exception as e:
+        
+        try:
+            size = path.stat().st_size
+            if size <= max_bytes:
+                return path.read_text(encoding='utf-8', errors='replace')
+            
+            tail_bytes = max_bytes - READ_HEAD_BYTES
+            with path.open('rb') as f:
+                head = f.read(READ_HEAD_BYTES)
+                f.seek(size - tail_bytes)
+                tail = f.read(tail_bytes)
+            marker = f"\n...[truncated {size - max_bytes} bytes]...\n"
+            return head.decode('utf-8', 'replace') + marker + tail.decode('utf-8', 'replace')
+        except OSError as e:
             print(f"Error reading file {filename}: {e}")
             return ""
     
-    def call_gemini_api(self, prompt):
+    def read_failure_context(self, filename, context_lines=FAILURE_CONTEXT_LINES):
+        """Return only the lines surrounding failure markers, in a single pass"""
+        path = Path(filename)
+        if not path.is_file():
+            return ""
+        
+        kept = []
+        before = deque(maxlen=context_lines)
+        after = 0
+        skipped = False
+        try:
+            with path.open('r', encoding='utf-8', errors='replace') as f:
+                for line in f:
+                    if any(marker in line for marker in FAILURE_MARKERS):
+                        if skipped and kept:
+                            kept.append("...\n")
+                        kept.extend(before)
+                        kept.append(line)
+                        before.clear()
+                        skipped = False
+                        after = context_lines
+                    elif after:
+                        kept.append(line)
+                        after -= 1
+                    else:
+                        skipped = skipped or len(before) == before.maxlen
+                        before.append(line)
+        except OSError:
+            return ""
+        
+        context = ''.join(kept)
+        if len(context) > READ_MAX_BYTES:
+            tail_chars = READ_MAX_BYTES - READ_HEAD_BYTES
+            marker = f"\n...[truncated {len(context) - READ_MAX_BYTES} chars]...\n"
+            context = context[:READ_HEAD_BYTES] + marker + context[-tail_chars:]
+        return context
+    
+    def _cache_path(self, prompt):
+        """Return the cache file path for a prompt"""
+        digest = hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+        return os.path.join(GEMINI_CACHE_DIR, f"{digest}.txt")
+    
+    def _read_cached_response(self, prompt):
+        """Return a cached Gemini response for the prompt, if any"""
+        path = self._cache_path(prompt)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                text = f.read()
+            # The workflow prunes entries by mtime, so keep hits fresh
+            os.utime(path)
+            return text
+        except OSError:
+            return None
+    
+    def _write_cached_response(self, prompt, text):
+        """Atomically persist a Gemini response for the prompt"""
+        try:
+            write_file_atomic(self._cache_path(prompt), text)
+        except OSError as e:
+            print(f"Failed to cache Gemini response: {e}")
+    
+    def call_gemini_api(self, prompt, instruction=None):
         """Call Gemini API for AI analysis"""
         if not self.gemini_api_key:
             print("GEMINI_API_KEY not found, using fallback analysis")
             return None
         
-        url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent?key={self.gemini_api_key}"
+        cache_key = f"{instruction}\n\n{prompt}" if instruction else prompt
+        cached = self._read_cached_response(cache_key)
+        if cached:
+            print("Using cached Gemini response")
+            return cached
+        
+        url = f"{GEMINI_API_BASE}/models/{GEMINI_MODEL}:generateContent?key={self.gemini_api_key}"
         
         payload = {
-            "contents": [{"parts": [{"text": prompt}]}],
+            "contents": [{"role": "user", "parts": [{"text": prompt}]}],
             "generationConfig": {
                 "temperature": 0.3,
                 "maxOutputTokens": 2048
             }
         }
         
+        if instruction:
+            payload["systemInstruction"] = {"parts": [{"text": instruction}]}
+        
         try:
-            response = requests.post(url, json=payload)
+            response = self.gemini_session.post(url, data=json_dumps(payload), headers=JSON_HEADERS)
             
             if not response.ok:
                 print(f"Gemini API error: {response.status_code}")
                 return None
             
-            data = response.json()
+            data = json_loads(response.content)
             if data.get('candidates') and data['candidates'][0].get('content'):
-                return data['candidates'][0]['content']['parts'][0]['text']
+                text = data['candidates'][0]['content']['parts'][0]['text']
+                self._write_cached_response(cache_key, text)
+                return text
             
             return None
         except Exception as e:
             print(f"Error calling Gemini API: {e}")
             return None
     
+    @functools.lru_cache(maxsize=None)
     def generate_ai_analysis(self):
-        """Generate AI analysis report"""
-        test_results = self.read_file('test_results.txt')
+        """Generate AI analysis report (inputs are fixed per run, so memoized)"""
+        # Only the failing parts of the test log are worth prompt tokens
+        test_results = self.read_failure_context('test_results.txt') or self.read_file('test_results.txt')
         analysis_data = self.read_file('analysis_report.md')
         
-        prompt = f"""You are an experienced Go developer and code reviewer. Please analyze the following code quality report and provide actionable recommendations.
-
-Project Context: This is a Go project called "catmit" (AI-powered commit message generator).
-
-## Test Results:
+        if not test_results.strip() and not analysis_data.strip():
+            print("No test results or analysis report, skipping AI analysis")
+            return NO_INPUT_REPORT
+        
+        prompt = f"""## Test Results:
 {test_results or 'No test failures detected.'}
 
 ## Static Analysis Report:
-{analysis_data or 'No static analysis issues detected.'}
-
-Please provide:
-1. **Priority Assessment**: Sort issues by urgency (Critical/High/Medium/Low)
-2. **Root Cause Analysis**: What could be causing these issues?
-3. **Specific Actions**: Concrete steps to fix each issue
-4. **Implementation Order**: Best sequence for solving improvements
-5. **Prevention Recommendations**: How to avoid these issues in the future
-
-Focus on practical, actionable advice suitable for Go projects. Be concise but comprehensive.
-Format your response using clear markdown headings and bullet points."""
+{analysis_data or 'No static analysis issues detected.'}"""
         
-        ai_report = self.call_gemini_api(prompt)
+        ai_report = self.call_gemini_api(prompt, ANALYSIS_INSTRUCTION)
         
         if not ai_report:
             print("Using fallback analysis engine")
-            insights = []
-            priority = 'medium'
-            
-            if 'FAIL' in test_results:
-                priority = 'critical'
-                insights.append('🚨 **Critical**: Test failures detected - fix immediately')
-            
-            if self.has_complexity:
-                insights.append('🔄 **High**: Complex functions found - consider refactoring')
-            
-            if self.has_const_issues:
-                insights.append('📋 **Medium**: Duplicate constants - extract as named constants')
-            
-            if self.has_large_files:
-                insights.append('📁 **Medium**: Large files detected - consider splitting')
-            
-            if self.has_static_issues:
-                insights.append('🔍 **High**: Static analysis issues - check staticcheck warnings')
+            flags = {
+                'fail': 'FAIL' in test_results,
+                'has_complexity': self.has_complexity,
+                'has_const_issues': self.has_const_issues,
+                'has_large_files': self.has_large_files,
+                'has_static_issues': self.has_static_issues
+            }
+            matched = [(priority, message) for key, priority, message in self._FALLBACK_MSGS if flags[key]]
+            priority = min((p for p, _ in matched), key=self._PRIORITY_ORDER.index, default='medium')
             
-            ai_report = f"""## 🤖 AI Code Review Summary (Fallback Analysis)
-
-**Priority**: {priority.upper()}
-
-### Identified Issues:
-{chr(10).join(insights)}
-
-### Recommended Actions:
-1. Fix test failures first (highest priority)
-2. Address staticcheck warnings
-3. Refactor complex functions
-4. Extract duplicate constants
-5. Split large files
-
-*Configure GEMINI_API_KEY for detailed AI insights.*"""
+            ai_report = self._FALLBACK_REPORT_TEMPLATE.format(
+                priority=priority.upper(),
+                insights="\n".join(message for _, message in matched)
+            )
         
         return ai_report
     
+    def format_test_output(self, test_results, budget):
+        """Embed test output in at most budget characters, linking or shrinking large logs"""
+        inline = self._INLINE_TEST_OUTPUT_TEMPLATE.format(test_results=test_results)
+        if len(inline) <= budget:
+            return inline
+        
+        if self.gist_token:
+            full_log = self.read_file('test_results.txt', max_bytes=GIST_MAX_BYTES)
+            gist_api = GitHubAPI(self.gist_token, self.repo)
+            url = gist_api.create_gist(f"Test output for {self.repo}@{self.short_sha}", 'test_results.txt', full_log)
+            if url:
+                return self._GIST_TEST_OUTPUT_TEMPLATE.format(url=url)
+        
+        import base64
+        import gzip
+        data = base64.b64encode(gzip.compress(test_results.encode('utf-8'))).decode()
+        compressed = self._COMPRESSED_TEST_OUTPUT_TEMPLATE.format(size=len(test_results), data=data)
+        if len(compressed) <= budget:
+            return compressed
+        
+        # Poorly compressible logs: keep the end, where go test reports failures
+        overhead = len(self._TRUNCATED_TEST_OUTPUT_TEMPLATE.format(size=len(test_results), test_results=''))
+        if budget <= overhead:
+            omitted = self._OMITTED_TEST_OUTPUT_TEMPLATE.format(size=len(test_results))
+            return omitted if len(omitted) <= budget else ''
+        return self._TRUNCATED_TEST_OUTPUT_TEMPLATE.format(
+            size=len(test_results), test_results=test_results[-(budget - overhead):])
+    
     def create_test_failure_issue(self):
         """Create test failure issue"""
         test_results = self.read_file('test_results.txt')
+        # generate_ai_analysis skips Gemini itself when both inputs are empty
         ai_report = self.generate_ai_analysis()
         
+        # Whatever the rest of the body leaves is available for the test output
+        budget = ISSUE_BODY_LIMIT - ISSUE_BODY_MARGIN - len(
+            self._ISSUE_BODY_TEMPLATE.format(sha=self.sha, ai_report=ai_report, test_output=''))
+        
         issue_data = {
-            "title": f"🚨 Test Failure ({self.sha[:7]})",
-            "body": f"""## Test Failure Detected
-
-Commit: {self.sha}
-
-{ai_report}
-
-### Test Results:
-<details>
-<summary>Click to view detailed test output</summary>
-
-```
-{test_results}
-```
-</details>
-
----
-*This issue was automatically created by AI-powered code analysis.*""",
+            "title": f"🚨 Test Failure ({self.short_sha})",
+            "body": self._ISSUE_BODY_TEMPLATE.format(
+                sha=self.sha,
+                ai_report=ai_report,
+                test_output=self.format_test_output(test_results, budget)
+            ),
             "labels": ["bug", "tests", "automated", "ai-reviewed"]
         }
         
@@ -191,110 +681,116 @@ Commit: {self.sha}
     
     def create_code_quality_pr(self):
         """Create code quality improvement PR"""
+        if not (self.has_complexity or self.has_const_issues or
+                self.has_large_files or self.has_static_issues):
+            print("No code quality issues flagged, skipping PR")
+            return None
+        
         analysis_report = self.read_file('analysis_report.md')
-        ai_report = self.generate_ai_analysis()
-        branch_name = f"code-quality-fixes-{self.sha[:7]}"
+        branch_name = f"code-quality-fixes-{self.short_sha}"
         
         try:
-            # Create new branch
+            # Look up IDs before creating anything, so this failing leaves nothing behind
+            repository_id, label_ids = self.github.get_repository_ids()
+            if not repository_id:
+                print(f"Could not look up repository {self.repo}, skipping PR")
+                return None
+            
+            # Create new branch before the AI analysis; it fails fast (e.g. branch
+            # already exists) and there is no point spending a Gemini call if it does
             ref_data = {
                 "ref": f"refs/heads/{branch_name}",
                 "sha": self.sha
             }
-            self.github.request('POST', '/git/refs', ref_data)
-            
-            # Create analysis file content
-            analysis_content = f"""# Code Quality Analysis Report
-
-Generated: {datetime.now().isoformat()}
-Commit: {self.sha}
-
-{analysis_report}
-
-## AI Analysis:
-{ai_report}
-
-## Recommended Actions:
-1. **Reduce Complexity**: Break down complex functions into smaller ones
-2. **Extract Constants**: Define constants for repeated literal values
-3. **Split Large Files**: Consider splitting large files into smaller modules
-4. **Fix Static Issues**: Address issues found by staticcheck
-
-## Next Steps:
-- Review the above findings
-- Apply suggested refactoring
-- Ensure all tests still pass
-- Update this file when complete
-"""
-            
-            # Create file
-            import base64
-            file_data = {
-                "message": "Add code quality analysis report",
-                "content": base64.b64encode(analysis_content.encode()).decode(),
-                "branch": branch_name
-            }
-            self.github.request('PUT', '/contents/CODE_QUALITY_ANALYSIS.md', file_data)
-            
-            # Create PR
-            pr_data = {
-                "title": f"🔧 Code Quality Improvements ({self.sha[:7]})",
-                "head": branch_name,
-                "base": "main",
-                "body": f"""## Automated Code Quality Review
-
-This PR was automatically created after detecting code quality issues in commit {self.sha}.
-
-{ai_report}
-
-### Detailed Analysis:
-<details>
-<summary>Click to view technical details</summary>
-
-{analysis_report}
-</details>
-
-### This PR contains:
-- Added `CODE_QUALITY_ANALYSIS.md` with detailed findings
-- AI-generated recommendations and action plan
-
-### Required Actions:
-- [ ] Review the AI analysis above
-- [ ] Follow the recommended implementation order
-- [ ] Apply suggested refactoring
-- [ ] Run tests to ensure changes don't break functionality
-- [ ] Update or remove analysis file after addressing issues
-
-**Note**: This is an automated PR with AI-assisted analysis. Please review carefully before merging.""",
-                "draft": True
-            }
-            
-            pr_result = self.github.request('POST', '/pulls', pr_data)
-            if not pr_result:
+            if self.github.request('POST', '/git/refs', ref_data) is None:
+                print(f"Could not create branch {branch_name}, skipping AI analysis")
                 return None
-            
-            # Add labels
-            labels_data = {
-                "labels": ["automated", "code-quality", "refactoring", "ai-reviewed"]
-            }
-            self.github.request('POST', f"/issues/{pr_result['number']}/labels", labels_data)
-            
-            # Add comment
-            comment_data = {
-                "body": """## 🤖 Code Quality Analysis
-
-I've analyzed the code and found some areas for improvement. Please review the `CODE_QUALITY_ANALYSIS.md` file added in this PR for detailed findings.
-
-If you have any questions about the recommendations, feel free to ask! You can also push new commits to this branch to run additional analysis."""
-            }
-            self.github.request('POST', f"/issues/{pr_result['number']}/comments", comment_data)
-            
-            print(f"Created PR #{pr_result['number']}: {pr_result['html_url']}")
-            return pr_result['number']
-            
         except Exception as e:
             print(f"Failed to create PR: {e}")
             return None
+        
+        try:
+            pr = self._create_code_quality_pr(analysis_report, branch_name, repository_id)
+        except Exception as e:
+            print(f"Failed to create PR: {e}")
+            pr = None
+        
+        if pr is None:
+            # An orphaned branch would make every re-run for this SHA fail to create it
+            print(f"Deleting branch {branch_name}")
+            try:
+                self.github.request('DELETE', f"/git/refs/heads/{branch_name}")
+            except Exception as e:
+                print(f"Failed to delete branch {branch_name}: {e}")
+            return None
+        
+        print(f"Created PR #{pr['number']}: {pr['url']}")
+        
+        # The PR is open now; deleting its head branch would close it, so
+        # failures from here on are only reported
+        try:
+            self._label_code_quality_pr(pr, label_ids)
+        except Exception as e:
+            print(f"Failed to label PR #{pr['number']}: {e}")
+        return pr['number']
+    
+    def _create_code_quality_pr(self, analysis_report, branch_name, repository_id):
+        ai_report = self.generate_ai_analysis()
+        
+        # Create analysis file content
+        analysis_content = self._ANALYSIS_FILE_TEMPLATE.format(
+            generated=datetime.now().isoformat(),
+            sha=self.sha,
+            analysis_report=analysis_report,
+            ai_report=ai_report
+        )
+        
+        # Commit file onto the new branch
+        import base64
+        commit_input = {
+            "branch": {"repositoryNameWithOwner": self.repo, "branchName": branch_name},
+            "message": {"headline": "Add code quality analysis report"},
+            "fileChanges": {
+                "additions": [{
+                    "path": "CODE_QUALITY_ANALYSIS.md",
+                    "contents": base64.b64encode(analysis_content.encode()).decode()
+                }]
+            },
+            "expectedHeadOid": self.sha
+        }
+        
+        # Create PR
+        pr_input = {
+            "repositoryId": repository_id,
+            "title": f"🔧 Code Quality Improvements ({self.short_sha})",
+            "headRefName": branch_name,
+            "baseRefName": "main",
+            "body": self._PR_BODY_TEMPLATE.format(sha=self.sha, ai_report=ai_report, analysis_report=analysis_report),
+            "draft": True
+        }
+        
+        pr_result = self.github.graphql(COMMIT_AND_PULL_REQUEST_MUTATION, {"commit": commit_input, "pullRequest": pr_input})
+        if not pr_result or not pr_result.get('createPullRequest'):
+            return None
+        return pr_result['createPullRequest']['pullRequest']
+    
+    def _label_code_quality_pr(self, pr, label_ids):
+        # Add labels and comment
+        labels = ["automated", "code-quality", "refactoring", "ai-reviewed"]
+        existing_label_ids = [label_ids[label.lower()] for label in labels if label.lower() in label_ids]
+        if existing_label_ids:
+            self.github.graphql(LABEL_AND_COMMENT_MUTATION, {
+                "prId": pr['id'],
+                "labelIds": existing_label_ids,
+                "body": self._PR_COMMENT
+            })
+        else:
+            self.github.graphql(COMMENT_MUTATION, {"prId": pr['id'], "body": self._PR_COMMENT})
+        
+        # GraphQL can only attach existing labels; REST creates missing ones
+        missing_labels = [label for label in labels if label.lower() not in label_ids]
+        if missing_labels:
+            self.github.request('POST', f"/issues/{pr['number']}/labels", {"labels": missing_labels})
     
     def run(self):
         """Run code review process"""
@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+# .github/scripts/test_code_review.py
+
+import os
+import tempfile
+import threading
+import time
+import unittest
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest import mock
+
+from code_review import (
+    GITHUB_MAX_RETRY_DELAY, READ_HEAD_BYTES, READ_MAX_BYTES, CodeReviewBot,
+    create_session, github_retry_delay, parse_retry_after,
+)
+
+BOT_ENV = {
+    'GITHUB_TOKEN': 'token',
+    'GITHUB_REPOSITORY': 'owner/repo',
+    'GITHUB_SHA': 'abcdef1234567890',
+}
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None, text=''):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.text = text
+
+
+class ParseRetryAfterTest(unittest.TestCase):
+    def test_seconds(self):
+        self.assertEqual(parse_retry_after('3'), 3.0)
+
+    def test_http_date(self):
+        delay = parse_retry_after(formatdate(time.time() + 30, usegmt=True))
+        self.assertAlmostEqual(delay, 30, delta=2)
+
+    def test_past_http_date(self):
+        self.assertLess(parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT'), 0)
+
+    def test_garbage(self):
+        self.assertIsNone(parse_retry_after('soon'))
+
+
+class GitHubRetryDelayTest(unittest.TestCase):
+    def test_success_is_not_retried(self):
+        self.assertIsNone(github_retry_delay(FakeResponse(201), 0, 'POST'))
+
+    def test_plain_403_is_not_retried(self):
+        response = FakeResponse(403, text='Resource not accessible by integration')
+        self.assertIsNone(github_retry_delay(response, 0, 'GET'))
+
+    def test_secondary_rate_limit_403_is_retried(self):
+        response = FakeResponse(403, text='You have exceeded a secondary rate limit')
+        self.assertIsNotNone(github_retry_delay(response, 0, 'POST'))
+
+    def test_retry_after_seconds(self):
+        response = FakeResponse(429, {'Retry-After': '3'})
+        self.assertEqual(github_retry_delay(response, 0, 'POST'), 3.0)
+
+    def test_retry_after_http_date(self):
+        response = FakeResponse(429, {'Retry-After': formatdate(time.time() + 10, usegmt=True)})
+        self.assertAlmostEqual(github_retry_delay(response, 0, 'POST'), 10, delta=2)
+
+    def test_retry_after_past_date_does_not_wait(self):
+        response = FakeResponse(429, {'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'})
+        self.assertEqual(github_retry_delay(response, 0, 'POST'), 0)
+
+    def test_unparseable_retry_after_falls_back_to_backoff(self):
+        response = FakeResponse(429, {'Retry-After': 'soon'})
+        delay = github_retry_delay(response, 2, 'POST')
+        self.assertTrue(2 <= delay <= 6)
+
+    def test_primary_rate_limit_waits_for_reset(self):
+        headers = {'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': str(int(time.time()) + 20)}
+        self.assertAlmostEqual(github_retry_delay(FakeResponse(403, headers), 0, 'POST'), 20, delta=2)
+
+    def test_distant_reset_gives_up(self):
+        headers = {'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': str(int(time.time()) + GITHUB_MAX_RETRY_DELAY + 60)}
+        self.assertIsNone(github_retry_delay(FakeResponse(403, headers), 0, 'GET'))
+
+    def test_server_error_retried_for_idempotent_methods(self):
+        self.assertIsNotNone(github_retry_delay(FakeResponse(502), 0, 'GET'))
+        self.assertIsNotNone(github_retry_delay(FakeResponse(503), 0, 'delete'))
+
+    def test_server_error_not_retried_for_post(self):
+        for status in (502, 503, 504):
+            self.assertIsNone(github_retry_delay(FakeResponse(status), 0, 'POST'))
+
+
+class RateLimitedHandler(BaseHTTPRequestHandler):
+    hits = 0
+
+    def do_DELETE(self):
+        RateLimitedHandler.hits += 1
+        self.send_response(429)
+        self.send_header('Retry-After', '0')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class CreateSessionTest(unittest.TestCase):
+    def test_adapter_leaves_status_retries_to_caller(self):
+        server = HTTPServer(('127.0.0.1', 0), RateLimitedHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        session = create_session()
+        session.mount('http://', session.get_adapter('https://'))
+        RateLimitedHandler.hits = 0
+        response = session.delete(f'http://127.0.0.1:{server.server_port}/')
+
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(RateLimitedHandler.hits, 1)
+
+
+class BotTestCase(unittest.TestCase):
+    """Runs each test in a scratch directory, where the bot reads its inputs"""
+
+    def setUp(self):
+        patcher = mock.patch.dict(os.environ, BOT_ENV, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        cwd = os.getcwd()
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        os.chdir(tmp.name)
+        self.addCleanup(os.chdir, cwd)
+
+    def write(self, filename, text):
+        with open(filename, 'w', encoding='utf-8') as f:
+            f.write(text)
+
+    def write_lines(self, filename, lines):
+        self.write(filename, ''.join(f"{line}\n" for line in lines))
+
+
+class ReadFileTest(BotTestCase):
+    def test_missing_file(self):
+        self.assertEqual(CodeReviewBot().read_file('missing.txt'), '')
+
+    def test_small_file_is_read_whole(self):
+        self.write('report.md', 'all of it\n')
+        self.assertEqual(CodeReviewBot().read_file('report.md'), 'all of it\n')
+
+    def test_large_file_keeps_head_and_tail(self):
+        tail_bytes = READ_MAX_BYTES - READ_HEAD_BYTES
+        self.write('big.txt', 'H' * READ_HEAD_BYTES + 'M' * 100000 + 'T' * tail_bytes)
+
+        content = CodeReviewBot().read_file('big.txt')
+
+        self.assertEqual(content, 'H' * READ_HEAD_BYTES + '\n...[truncated 100000 bytes]...\n' + 'T' * tail_bytes)
+
+    def test_max_bytes_override(self):
+        self.write('big.txt', 'x' * (READ_MAX_BYTES + 1))
+        self.assertEqual(CodeReviewBot().read_file('big.txt', max_bytes=READ_MAX_BYTES + 1), 'x' * (READ_MAX_BYTES + 1))
+
+
+class ReadFailureContextTest(BotTestCase):
+    def context(self, lines, context_lines=2):
+        self.write_lines('test_results.txt', lines)
+        return CodeReviewBot().read_failure_context('test_results.txt', context_lines)
+
+    def test_marker_at_start(self):
+        lines = ['--- FAIL: TestA'] + [f"line {i}" for i in range(10)]
+        self.assertEqual(self.context(lines), '--- FAIL: TestA\nline 0\nline 1\n')
+
+    def test_marker_at_end(self):
+        lines = [f"line {i}" for i in range(10)] + ['--- FAIL: TestZ']
+        self.assertEqual(self.context(lines), 'line 8\nline 9\n--- FAIL: TestZ\n')
+
+    def test_close_markers_share_context(self):
+        lines = ['a', '--- FAIL: TestA', 'b', '--- FAIL: TestB', 'c', 'd', 'e']
+        self.assertEqual(self.context(lines), 'a\n--- FAIL: TestA\nb\n--- FAIL: TestB\nc\nd\n')
+
+    def test_adjacent_windows_are_not_separated(self):
+        lines = ['--- FAIL: TestA', 'x1', 'x2', 'x3', 'x4', '--- FAIL: TestB']
+        self.assertEqual(self.context(lines), ''.join(f"{line}\n" for line in lines))
+
+    def test_skipped_lines_are_marked(self):
+        lines = ['--- FAIL: TestA', 'x1', 'x2', 'x3', 'x4', 'x5', 'x6', 'panic: boom']
+        self.assertEqual(self.context(lines), '--- FAIL: TestA\nx1\nx2\n...\nx5\nx6\npanic: boom\n')
+
+    def test_no_markers(self):
+        self.assertEqual(self.context(['ok  \tgithub.com/penwyp/catmit\t0.1s']), '')
+
+    def test_long_context_is_capped(self):
+        lines = [f"--- FAIL: Test{i} {'.' * 40}" for i in range(5000)]
+
+        context = self.context(lines)
+
+        self.assertIn('chars]...', context)
+        self.assertTrue(context.startswith(lines[0]))
+        self.assertTrue(context.endswith(lines[-1] + '\n'))
+        self.assertLess(len(context), READ_MAX_BYTES + 100)
+
+    def test_analysis_falls_back_to_whole_log_without_markers(self):
+        log = 'ok  \tgithub.com/penwyp/catmit\t0.1s\n'
+        self.write('test_results.txt', log)
+
+        bot = CodeReviewBot()
+        with mock.patch.object(bot, 'call_gemini_api', return_value='report') as call:
+            self.assertEqual(bot.generate_ai_analysis(), 'report')
+
+        self.assertIn(log, call.call_args[0][0])
+
+
+class FormatTestOutputTest(BotTestCase):
+    def bot(self, gist_token=None):
+        if gist_token:
+            os.environ['GIST_TOKEN'] = gist_token
+        return CodeReviewBot()
+
+    def noisy_log(self, size):
+        # Random bytes stay large after gzip+base64
+        return os.urandom(size // 2).hex()
+
+    def test_small_log_is_inlined(self):
+        output = self.bot().format_test_output('--- FAIL: TestA', 1000)
+        self.assertIn('--- FAIL: TestA', output)
+        self.assertLessEqual(len(output), 1000)
+
+    def test_compressible_log_is_embedded_compressed(self):
+        output = self.bot().format_test_output('--- FAIL: TestA\n' * 5000, 2000)
+        self.assertIn('base64 -d | gunzip', output)
+        self.assertLessEqual(len(output), 2000)
+
+    def test_incompressible_log_keeps_tail(self):
+        log = self.noisy_log(20000) + 'END'
+
+        output = self.bot().format_test_output(log, 2000)
+
+        self.assertIn('showing the end of the log', output)
+        self.assertIn('END\n```', output)
+        self.assertEqual(len(output), 2000)
+
+    def test_gist_not_attempted_without_gist_token(self):
+        with mock.patch('code_review.GitHubAPI.create_gist') as create_gist:
+            output = self.bot().format_test_output(self.noisy_log(20000), 2000)
+        create_gist.assert_not_called()
+        self.assertLessEqual(len(output), 2000)
+
+    def test_gist_used_with_gist_token(self):
+        log = self.noisy_log(20000)
+        self.write('test_results.txt', log)
+        url = 'https://gist.github.com/owner/1'
+
+        with mock.patch('code_review.GitHubAPI.create_gist', return_value=url) as create_gist:
+            output = self.bot(gist_token='gist').format_test_output(log, 2000)
+
+        self.assertEqual(create_gist.call_args[0][2], log)
+        self.assertIn(url, output)
+        self.assertLessEqual(len(output), 2000)
+
+    def test_failed_gist_falls_back(self):
+        with mock.patch('code_review.GitHubAPI.create_gist', return_value=None):
+            output = self.bot(gist_token='gist').format_test_output(self.noisy_log(20000), 2000)
+        self.assertIn('showing the end of the log', output)
+        self.assertLessEqual(len(output), 2000)
+
+    def test_budget_smaller_than_wrapper(self):
+        bot = self.bot()
+        log = self.noisy_log(20000)
+
+        omitted = bot.format_test_output(log, 100)
+        self.assertIn('omitted', omitted)
+        self.assertLessEqual(len(omitted), 100)
+        self.assertEqual(bot.format_test_output(log, 10), '')
+
+
+if __name__ == '__main__':
+    unittest.main()